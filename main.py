@@ -20,15 +20,23 @@ def main(settings_file_path: str = 'data/settings.yaml'):
     logger.info("Application start")
     logger.info("Load config from %s", settings_file_path)
 
+    from modules.memory_profiler import MemoryProfiler
+    memory_profiler = MemoryProfiler(**settings.get('memory_profiling', {}))
+
     from modules.pusher import TheHivePusher
-    pusher = TheHivePusher(settings['thehive'], settings['hbase_event_loader'])
+    pusher = TheHivePusher(settings['thehive'], settings['hbase_event_loader'], settings.get('thehive_limiter'),
+                           memory_profiler, settings.get('alert_index'))
+
+    deferred_enrichment_thread = threading.Thread(target=pusher.deferred_enrichment.run, daemon=True)
+    deferred_enrichment_thread.start()
 
     from modules.kafka_consumer import prepare_consumer
     consumer = prepare_consumer(settings)
     consumer.create_consumer()
 
     from modules.app_metrics import run_metrics_webserver
-    metrics_thread = threading.Thread(target=run_metrics_webserver, daemon=True)
+    metrics_thread = threading.Thread(target=run_metrics_webserver, kwargs={'memory_profiler': memory_profiler},
+                                      daemon=True)
     metrics_thread.start()
 
     try:
@@ -47,6 +55,8 @@ def main(settings_file_path: str = 'data/settings.yaml'):
     except BaseException as e:
         logger.error("Some wtf shit is happened: %s", str(e))
         sys.exit(42)
+    finally:
+        pusher.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Optional
+
+import requests
+from appmetrics import metrics
+from thehive4py.exceptions import TheHiveException
+
+logger = logging.getLogger('thehive_incidents_pusher')
+
+
+class LimiterRejectedError(TheHiveException):
+    pass
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limiter of in-flight requests to TheHive.
+
+    The limit grows by one request per "round trip" while latency stays below the threshold and is cut
+    by `backoff_ratio` on 429/5xx responses, timeouts and slow responses. `Retry-After` pauses all callers.
+    Concurrency comes from the pusher's alert sender pool of `max_limit` threads; requests made from the
+    Kafka loop thread (cases, merges, tags) only get pacing and backoff.
+    """
+
+    def __init__(self, initial_limit: int = 4, min_limit: int = 1, max_limit: int = 16,
+                 latency_threshold: float = 2.0, backoff_ratio: float = 0.5, max_queue_wait: float = 120.0,
+                 default_retry_after: float = 5.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_threshold = latency_threshold
+        self.backoff_ratio = backoff_ratio
+        self.max_queue_wait = max_queue_wait
+        self.default_retry_after = default_retry_after
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        metrics.notify('thehive_limiter_limit', self.limit)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        self._acquire()
+        started_at = time.monotonic()
+        overloaded = False
+        retry_after = None
+        try:
+            response = func(*args, **kwargs)
+            if isinstance(response, requests.Response) and \
+                    (response.status_code == 429 or response.status_code >= 500):
+                overloaded = True
+                retry_after = self._parse_retry_after(response)
+                if retry_after is None and response.status_code == 429:
+                    retry_after = self.default_retry_after
+            return response
+        except TheHiveException as exc:
+            # thehive4py wraps requests exceptions without chaining them explicitly
+            if isinstance(exc.__context__, (requests.Timeout, requests.ConnectionError)):
+                overloaded = True
+            raise exc
+        except (requests.Timeout, requests.ConnectionError) as exc:
+            overloaded = True
+            raise exc
+        finally:
+            self._release(time.monotonic() - started_at, overloaded, retry_after)
+
+    def _acquire(self) -> None:
+        started_at = time.monotonic()
+        deadline = started_at + self.max_queue_wait
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now >= self._paused_until and self._in_flight < self.limit:
+                    break
+                if now >= deadline:
+                    metrics.notify('thehive_limiter_rejections', 1)
+                    logger.warning("TheHive limiter rejects request after %.2f s of waiting (limit %s)",
+                                   now - started_at, self.limit)
+                    raise LimiterRejectedError("Request to TheHive rejected by adaptive limiter")
+                wake_at = self._paused_until if now < self._paused_until else deadline
+                self._cond.wait(min(wake_at, deadline) - now)
+            self._in_flight += 1
+        metrics.notify('thehive_limiter_queue_wait', time.monotonic() - started_at)
+
+    def _release(self, latency: float, overloaded: bool, retry_after: Optional[float]) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            if overloaded or latency > self.latency_threshold:
+                self._limit = max(float(self.min_limit), self._limit * self.backoff_ratio)
+                logger.info("TheHive looks overloaded (latency %.2f s), decrease limit to %s", latency, self.limit)
+            else:
+                self._limit = min(float(self.max_limit), self._limit + 1 / self._limit)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logger.warning("TheHive asks to retry after %.2f s, pause requests", retry_after)
+            self._cond.notify_all()
+        metrics.notify('thehive_limiter_limit', self.limit)
+
+    @staticmethod
+    def _parse_retry_after(response: requests.Response) -> Optional[float]:
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            logger.warning("Can't parse Retry-After header: %s", value)
+            return None
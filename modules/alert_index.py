@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import math
+import threading
+from typing import Iterator, Optional
+
+from appmetrics import metrics
+
+from modules.dbm_storage import iter_keys, open_storage, sync_storage
+
+logger = logging.getLogger('thehive_incidents_pusher')
+
+
+class BloomFilter:
+    def __init__(self, expected_items: int, false_positive_rate: float):
+        self.size = max(int(-expected_items * math.log(false_positive_rate) / math.log(2) ** 2), 8)
+        self.hashes_count = max(int(round(self.size / expected_items * math.log(2))), 1)
+        self.items_count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> Iterator[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.items_count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    @property
+    def estimated_false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hashes_count * self.items_count / self.size)) ** self.hashes_count
+
+
+class AlertIndex:
+    """
+    Persistent index of already pushed alerts: sourceRef -> TheHive alert id.
+
+    The exact map lives in a dbm file, an in-memory Bloom filter rebuilt on start answers most
+    lookups of unknown sourceRefs without touching the disk. When disabled, nothing is ever found.
+    """
+
+    def __init__(self, enabled: bool = False, path: str = 'data/alert_index', expected_items: int = 1000000,
+                 false_positive_rate: float = 0.001):
+        self.enabled = enabled
+        self._db = None
+        self._bloom_filter = None
+        self._count = 0
+        self._misses = 0
+        self._false_positives = 0
+        self._lock = threading.Lock()
+        if not self.enabled:
+            return
+        self._db = open_storage(path)
+        self._bloom_filter = BloomFilter(expected_items, false_positive_rate)
+        for key in iter_keys(self._db):
+            self._bloom_filter.add(key.decode())
+            self._count += 1
+        logger.info("Load alert index from %s with %s items", path, self.size)
+        self._report()
+
+    @property
+    def size(self) -> int:
+        return self._count
+
+    def get(self, source_ref: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            maybe_known = source_ref in self._bloom_filter
+            alert_id = self._db.get(source_ref.encode()) if maybe_known else None
+            if alert_id is not None:
+                return alert_id.decode()
+            self._misses += 1
+            if maybe_known:
+                self._false_positives += 1
+                metrics.notify('alert_index_false_positives', 1)
+            metrics.notify('alert_index_observed_false_positive_rate', self._false_positives / self._misses)
+        return None
+
+    def add(self, source_ref: str, alert_id: str) -> None:
+        if not self.enabled:
+            return
+        key = source_ref.encode()
+        with self._lock:
+            if key not in self._db:
+                self._bloom_filter.add(source_ref)
+                self._count += 1
+            self._db[key] = alert_id.encode()
+            sync_storage(self._db)
+            self._report()
+
+    def remove(self, source_ref: str) -> None:
+        # Bloom filter can't forget keys, later lookups of this sourceRef count as false positives
+        if not self.enabled:
+            return
+        key = source_ref.encode()
+        with self._lock:
+            if key in self._db:
+                del self._db[key]
+                self._count -= 1
+                sync_storage(self._db)
+                self._report()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _report(self) -> None:
+        metrics.notify('alert_index_size', self.size)
+        metrics.notify('alert_index_estimated_false_positive_rate', self._bloom_filter.estimated_false_positive_rate)
@@ -2,7 +2,9 @@ import logging
 
 from appmetrics import metrics
 from appmetrics.histogram import SlidingTimeWindowReservoir
-from flask import Flask
+from flask import Flask, Response, request
+
+from modules.memory_profiler import MemoryProfiler, SNAPSHOT_KEY_TYPES, incident_peak_memory_metric_names
 
 logger = logging.getLogger('thehive_incidents_pusher')
 
@@ -17,6 +19,19 @@ def register_app_metrics():
     metrics.new_counter("loaded_hbase_raw_events")
     metrics.new_counter("thehive_api_errors")
     metrics.new_counter("hbase_errors")
+    metrics.new_counter("thehive_limiter_rejections")
+    metrics.new_gauge("thehive_limiter_limit")
+    for table in ("raw", "normalized"):
+        metrics.new_counter(f"hbase_{table}_circuit_breaker_rejections")
+        metrics.new_gauge(f"hbase_{table}_circuit_breaker_state")
+    metrics.new_gauge("deferred_enrichments_backlog")
+    metrics.new_counter("deferred_enrichments_completed")
+    metrics.new_counter("deferred_enrichments_dropped")
+    metrics.new_counter("alert_index_skipped_alerts")
+    metrics.new_counter("alert_index_false_positives")
+    metrics.new_gauge("alert_index_size")
+    metrics.new_gauge("alert_index_estimated_false_positive_rate")
+    metrics.new_gauge("alert_index_observed_false_positive_rate")
 
     if not metrics.REGISTRY.get("full_processing_time"):
         metrics.new_histogram("full_processing_time", SlidingTimeWindowReservoir())
@@ -34,6 +49,11 @@ def register_app_metrics():
         metrics.new_histogram("thehive_alert_preparing", SlidingTimeWindowReservoir())
     if not metrics.REGISTRY.get("thehive_case_preparing"):
         metrics.new_histogram("thehive_case_preparing", SlidingTimeWindowReservoir())
+    if not metrics.REGISTRY.get("thehive_limiter_queue_wait"):
+        metrics.new_histogram("thehive_limiter_queue_wait", SlidingTimeWindowReservoir())
+    for name in incident_peak_memory_metric_names():
+        if not metrics.REGISTRY.get(name):
+            metrics.new_histogram(name, SlidingTimeWindowReservoir())
 
     metrics.tag("received_kafka_messages", "default")
     metrics.tag("created_thehive_alerts", "default")
@@ -44,6 +64,20 @@ def register_app_metrics():
     metrics.tag("loaded_hbase_raw_events", "default")
     metrics.tag("thehive_api_errors", "default")
     metrics.tag("hbase_errors", "default")
+    metrics.tag("thehive_limiter_rejections", "default")
+    metrics.tag("thehive_limiter_limit", "default")
+    metrics.tag("thehive_limiter_queue_wait", "default")
+    for table in ("raw", "normalized"):
+        metrics.tag(f"hbase_{table}_circuit_breaker_rejections", "default")
+        metrics.tag(f"hbase_{table}_circuit_breaker_state", "default")
+    metrics.tag("deferred_enrichments_backlog", "default")
+    metrics.tag("deferred_enrichments_completed", "default")
+    metrics.tag("deferred_enrichments_dropped", "default")
+    metrics.tag("alert_index_skipped_alerts", "default")
+    metrics.tag("alert_index_false_positives", "default")
+    metrics.tag("alert_index_size", "default")
+    metrics.tag("alert_index_estimated_false_positive_rate", "default")
+    metrics.tag("alert_index_observed_false_positive_rate", "default")
     metrics.tag("full_processing_time", "default")
     metrics.tag("hbase_loading_time", "default")
     metrics.tag("full_processing_time", "profiling")
@@ -54,11 +88,37 @@ def register_app_metrics():
     metrics.tag("set_final_tag", "profiling")
     metrics.tag("thehive_alert_preparing", "profiling")
     metrics.tag("thehive_case_preparing", "profiling")
+    for name in incident_peak_memory_metric_names():
+        metrics.tag(name, "memory")
     logger.info("Register some metrics for app: %s", str(metrics.REGISTRY))
 
 
-def run_metrics_webserver(host: str = '0.0.0.0', port: int = 5000):
+def run_metrics_webserver(host: str = '0.0.0.0', port: int = 5000, memory_profiler: MemoryProfiler = None):
     app = Flask(__name__)
     from appmetrics.wsgi import AppMetricsMiddleware
     app.wsgi_app = AppMetricsMiddleware(app.wsgi_app, "app_metrics")
+    if memory_profiler is not None and memory_profiler.enabled:
+        register_memory_profiling_routes(app, memory_profiler)
     app.run(host, port, debug=False)
+
+
+def register_memory_profiling_routes(app: Flask, memory_profiler: MemoryProfiler):
+    @app.route('/memory/snapshot')
+    def memory_snapshot():
+        return Response(
+            memory_profiler.dump_snapshot(),
+            mimetype='application/octet-stream',
+            headers={'Content-Disposition': 'attachment; filename=snapshot.tracemalloc'}
+        )
+
+    @app.route('/memory/top')
+    def memory_top():
+        key_type = request.args.get('key_type', 'lineno')
+        if key_type not in SNAPSHOT_KEY_TYPES:
+            return Response(f"key_type should be one of: {', '.join(SNAPSHOT_KEY_TYPES)}", status=400,
+                            mimetype='text/plain')
+        stats = memory_profiler.top_allocations_diff(
+            key_type=key_type,
+            since_baseline=request.args.get('since') == 'baseline'
+        )
+        return Response('\n'.join(stats), mimetype='text/plain')
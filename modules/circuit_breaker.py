@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Tuple, Type
+
+from appmetrics import metrics
+
+logger = logging.getLogger('thehive_incidents_pusher')
+
+
+class CircuitBreakerOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Failure rate based circuit breaker.
+
+    Trips to OPEN when at least `failure_rate_threshold` of the last `window_size` calls failed, rejects
+    calls for `recovery_timeout` seconds and then lets a single probe call through (HALF_OPEN).
+    """
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(self, name: str, window_size: int = 20, min_calls: int = 5, failure_rate_threshold: float = 0.5,
+                 recovery_timeout: float = 30.0, expected_exceptions: Tuple[Type[Exception], ...] = (Exception,)):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.recovery_timeout = recovery_timeout
+        self.expected_exceptions = expected_exceptions
+        self._results = deque(maxlen=window_size)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        metrics.notify(f'{self.name}_circuit_breaker_state', self._state)
+
+    @property
+    def state(self) -> int:
+        with self._lock:
+            return self._current_state()
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            state = self._current_state()
+            if state == self.OPEN or state == self.HALF_OPEN and self._probe_in_flight:
+                metrics.notify(f'{self.name}_circuit_breaker_rejections', 1)
+                raise CircuitBreakerOpenError(f"Circuit breaker {self.name} is open")
+            is_probe = state == self.HALF_OPEN
+            if is_probe:
+                self._probe_in_flight = True
+        try:
+            result = func(*args, **kwargs)
+        except self.expected_exceptions as err:
+            self._on_call_finished(success=False, is_probe=is_probe)
+            raise err
+        except BaseException as err:
+            # unexpected errors tell nothing about the service, only free the probe slot
+            if is_probe:
+                with self._lock:
+                    self._probe_in_flight = False
+            raise err
+        self._on_call_finished(success=True, is_probe=is_probe)
+        return result
+
+    def _current_state(self) -> int:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._set_state(self.HALF_OPEN)
+        return self._state
+
+    def _on_call_finished(self, success: bool, is_probe: bool) -> None:
+        with self._lock:
+            if is_probe:
+                self._probe_in_flight = False
+                if success:
+                    self._results.clear()
+                    self._set_state(self.CLOSED)
+                else:
+                    self._open()
+                return
+            if self._state != self.CLOSED:
+                # late results of calls started before the breaker tripped must not postpone the probe
+                return
+            self._results.append(success)
+            failures = self._results.count(False)
+            if len(self._results) >= self.min_calls and \
+                    failures / len(self._results) >= self.failure_rate_threshold:
+                self._open()
+
+    def _open(self) -> None:
+        self._opened_at = time.monotonic()
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state: int) -> None:
+        if state != self._state:
+            logger.warning("Circuit breaker %s changes state from %s to %s", self.name, self._state, state)
+        self._state = state
+        metrics.notify(f'{self.name}_circuit_breaker_state', state)
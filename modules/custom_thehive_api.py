@@ -1,18 +1,92 @@
 import json
-from typing import List
+from typing import Dict, List
 
 import requests
 from thehive4py.api import TheHiveApi, TheHiveException
+from thehive4py.exceptions import AlertException, CaseException
+from thehive4py.models import Alert, Case, Version
 
 
 class CustomTheHiveApi(TheHiveApi):
+    """
+    TheHiveApi with a few extra endpoints. Methods used by the pusher are overridden to pass `timeout`,
+    thehive4py 1.8.1 sends every request without it.
+    """
+
+    def __init__(self, *args, timeout: float = 60.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+
+    def create_case(self, case: Case) -> requests.Response:
+        req = self.url + "/api/case"
+        data = case.jsonify(excludes=['id'])
+        try:
+            return requests.post(req, headers={'Content-Type': 'application/json'}, data=data, proxies=self.proxies,
+                                 auth=self.auth, verify=self.cert, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise CaseException("Case create error: {}".format(e))
+
+    def update_case(self, case: Case, fields: List[str] = None) -> requests.Response:
+        req = self.url + "/api/case/{}".format(case.id)
+        update_keys = [
+            'title', 'description', 'severity', 'startDate', 'owner', 'flag', 'tlp', 'pap', 'tags', 'status',
+            'resolutionStatus', 'impactStatus', 'summary', 'endDate', 'metrics', 'customFields'
+        ]
+        data = {k: v for k, v in case.__dict__.items() if (fields and k in fields) or (not fields and k in update_keys)}
+        try:
+            return requests.patch(req, headers={'Content-Type': 'application/json'}, json=data, proxies=self.proxies,
+                                  auth=self.auth, verify=self.cert, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise CaseException("Case update error: {}".format(e))
+
+    def create_alert(self, alert: Alert) -> requests.Response:
+        req = self.url + "/api/alert"
+        to_exclude = ['id']
+        # TheHive 3 doesn't know PAP and external links
+        if self.version is Version.THEHIVE_3.value:
+            to_exclude.extend(['pap', 'externalLink'])
+        data = alert.jsonify(excludes=to_exclude)
+        try:
+            return requests.post(req, headers={'Content-Type': 'application/json'}, data=data, proxies=self.proxies,
+                                 auth=self.auth, verify=self.cert, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise AlertException("Alert create error: {}".format(e))
+
+    def get_alert(self, alert_id: str, similar_cases: bool = False) -> requests.Response:
+        req = self.url + "/api/alert/{}".format(alert_id)
+        params = {"similarity": int(similar_cases)} if similar_cases else {}
+        try:
+            return requests.get(req, params=params, proxies=self.proxies, auth=self.auth, verify=self.cert,
+                                timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise AlertException("Alert fetch error: {}".format(e))
+
+    def find_alerts(self, **attributes) -> requests.Response:
+        req = self.url + "/api/alert/_search"
+        params = {"range": attributes.get("range", "all"), "sort": attributes.get("sort", [])}
+        data = {"query": attributes.get("query", {})}
+        try:
+            return requests.post(req, params=params, json=data, proxies=self.proxies, auth=self.auth,
+                                 verify=self.cert, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise AlertException("Alert search error: {}".format(e))
+
+    def promote_alert_to_case(self, alert_id: str, case_template: str = None) -> requests.Response:
+        req = self.url + "/api/alert/{}/createCase".format(alert_id)
+        try:
+            data = json.dumps({"caseTemplate": case_template})
+            return requests.post(req, headers={'Content-Type': 'application/json'}, data=data, proxies=self.proxies,
+                                 auth=self.auth, verify=self.cert, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise AlertException("Couldn't promote alert to case: {}".format(e))
+
     def merge_alerts_into_case(self, case_id: str, alert_ids: List[str]) -> requests.Response:
         req = self.url + "/api/alert/merge/_bulk"
 
         try:
             data = json.dumps({"caseId": case_id, "alertIds": alert_ids})
             return requests.post(req, headers={'Content-Type': 'application/json'}, data=data, proxies=self.proxies,
-                                 auth=self.auth, verify=self.cert)
+                                 auth=self.auth, verify=self.cert, timeout=self.timeout)
         except requests.exceptions.RequestException as e:
             raise TheHiveException("Merge alerts into case error: {}".format(e))
 
@@ -20,6 +94,15 @@ class CustomTheHiveApi(TheHiveApi):
         req = self.url + '/api/list/custom_fields'
         try:
             return requests.get(req, headers={'Content-Type': 'application/json'}, proxies=self.proxies,
-                                auth=self.auth, verify=self.cert)
+                                auth=self.auth, verify=self.cert, timeout=self.timeout)
         except requests.exceptions.RequestException as e:
             raise TheHiveException("Getting custom fields error: {}".format(e))
+
+    def update_custom_field(self, entity_type: str, entity_id: str, name: str, value: Dict) -> requests.Response:
+        req = self.url + "/api/{}/{}".format(entity_type, entity_id)
+        try:
+            data = json.dumps({"customFields.{}".format(name): value})
+            return requests.patch(req, headers={'Content-Type': 'application/json'}, data=data, proxies=self.proxies,
+                                  auth=self.auth, verify=self.cert, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise TheHiveException("Update custom field error: {}".format(e))
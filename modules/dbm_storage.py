@@ -0,0 +1,31 @@
+import dbm
+import os
+from typing import Iterator
+
+
+def open_storage(path: str):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return dbm.open(path, 'c')
+
+
+def sync_storage(storage) -> None:
+    # dbm.ndbm has no sync and writes through on every update
+    if hasattr(storage, 'sync'):
+        storage.sync()
+
+
+def iter_keys(storage) -> Iterator[bytes]:
+    # dbm.gnu walks the file key by key, other backends may only return the full list of keys
+    if hasattr(storage, 'firstkey'):
+        key = storage.firstkey()
+        while key is not None:
+            yield key
+            key = storage.nextkey(key)
+        return
+    try:
+        keys = iter(storage)
+    except TypeError:
+        keys = iter(storage.keys())
+    yield from keys
@@ -0,0 +1,150 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, List, NamedTuple, NoReturn, Optional
+
+from appmetrics import metrics
+from requests import HTTPError
+from thehive4py.exceptions import TheHiveException
+
+from modules.adaptive_limiter import AdaptiveLimiter
+from modules.custom_thehive_api import CustomTheHiveApi
+from modules.dbm_storage import open_storage, sync_storage
+from modules.hbase_event_loader import HbaseEventsLoader, HbaseUnavailableError
+
+logger = logging.getLogger('thehive_incidents_pusher')
+
+
+INCIDENT = 'incident'
+
+
+class DeferredEnrichment(NamedTuple):
+    # 'alert' and 'case' wait for raw logs, 'incident' waits for normalized events to push alerts of the case
+    entity_type: str
+    entity_id: str
+    event_ids: List[str]
+    order: int = 0
+    tags: List[str] = []
+
+    @property
+    def key(self) -> str:
+        return f'{self.entity_type}:{self.entity_id}'
+
+
+class DeferredEnrichmentWorker:
+    """
+    Backlog of work skipped while HBase was unavailable: alerts and cases created without raw logs and
+    cases created without alerts.
+
+    The backlog is kept in a dbm file, so it survives restarts after the Kafka message has been committed.
+    `run` is meant for a background thread: it periodically updates the `raw` custom field of alerts and
+    cases and hands incidents over to `incident_alerts_pusher`, stopping at the first HBase or TheHive
+    error until the next round.
+    """
+
+    def __init__(self, api: CustomTheHiveApi, limiter: AdaptiveLimiter, hbase_event_loader: HbaseEventsLoader,
+                 interval: float = 30.0, max_backlog: int = 100000, path: str = 'data/deferred_enrichments',
+                 incident_alerts_pusher: Callable[[str, List[str], List[str]], None] = None):
+        self.api = api
+        self.incident_alerts_pusher = incident_alerts_pusher
+        self.limiter = limiter
+        self.hbase_event_loader = hbase_event_loader
+        self.interval = interval
+        self.max_backlog = max_backlog
+        self._lock = threading.Lock()
+        self._storage = open_storage(path)
+        self._backlog = deque(key.decode() for key in self._storage.keys())
+        logger.info("Load %s deferred enrichments from %s", len(self._backlog), path)
+        metrics.notify('deferred_enrichments_backlog', len(self._backlog))
+
+    @property
+    def backlog_size(self) -> int:
+        return len(self._backlog)
+
+    def defer(self, entity_type: str, entity_id: str, event_ids: List[str], order: int = 0,
+              tags: List[str] = None) -> NoReturn:
+        item = DeferredEnrichment(entity_type, entity_id, list(event_ids), order, list(tags or []))
+        with self._lock:
+            if len(self._backlog) >= self.max_backlog:
+                metrics.notify('deferred_enrichments_dropped', 1)
+                logger.warning("Deferred enrichments backlog is full, drop enrichment of %s %s",
+                               entity_type, entity_id)
+                return
+            if item.key.encode() not in self._storage:
+                self._backlog.append(item.key)
+            self._storage[item.key.encode()] = json.dumps(item._asdict()).encode()
+            sync_storage(self._storage)
+            metrics.notify('deferred_enrichments_backlog', len(self._backlog))
+        logger.info("Defer enrichment of %s %s", entity_type, entity_id)
+
+    def run(self) -> NoReturn:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.process_backlog()
+            except Exception as err:
+                logger.error("Deferred enrichment round failed: %s", str(err))
+
+    def process_backlog(self) -> NoReturn:
+        while True:
+            item = self._head()
+            if item is None:
+                break
+            try:
+                if item.entity_type == INCIDENT:
+                    self.incident_alerts_pusher(item.entity_id, item.event_ids, item.tags)
+                else:
+                    self._enrich_with_raw(item)
+            except HbaseUnavailableError as err:
+                logger.info("HBase is still unavailable, postpone deferred enrichments: %s", str(err))
+                break
+            except HTTPError as exc:
+                metrics.notify('thehive_api_errors', 1)
+                if exc.response.status_code != 429 and exc.response.status_code < 500:
+                    metrics.notify('deferred_enrichments_dropped', 1)
+                    logger.warning("Drop deferred enrichment of %s %s: %s",
+                                   item.entity_type, item.entity_id, str(exc))
+                    self._remove_head()
+                    continue
+                logger.error("TheHive error during deferred enrichment: %s", str(exc))
+                break
+            except TheHiveException as exc:
+                metrics.notify('thehive_api_errors', 1)
+                logger.error("TheHive error during deferred enrichment: %s", str(exc))
+                break
+            except Exception as err:
+                metrics.notify('deferred_enrichments_dropped', 1)
+                logger.warning("Drop deferred enrichment of %s %s: %s", item.entity_type, item.entity_id, str(err))
+                self._remove_head()
+                continue
+            metrics.notify('deferred_enrichments_completed', 1)
+            logger.info("Successfully complete deferred enrichment of %s %s", item.entity_type, item.entity_id)
+            self._remove_head()
+
+    def _enrich_with_raw(self, item: DeferredEnrichment) -> NoReturn:
+        raw_logs = self.hbase_event_loader.get_raw_events(item.event_ids)
+        response = self.limiter.call(
+            self.api.update_custom_field, item.entity_type, item.entity_id, 'raw',
+            {'string': ';\n'.join(raw_logs), 'order': item.order}
+        )
+        response.raise_for_status()
+
+    def close(self) -> None:
+        with self._lock:
+            self._storage.close()
+
+    def _head(self) -> Optional[DeferredEnrichment]:
+        # Only this worker removes items, so the head stays in place until _remove_head
+        with self._lock:
+            if not self._backlog:
+                return None
+            return DeferredEnrichment(**json.loads(self._storage[self._backlog[0].encode()].decode()))
+
+    def _remove_head(self) -> None:
+        with self._lock:
+            key = self._backlog.popleft()
+            del self._storage[key.encode()]
+            sync_storage(self._storage)
+            metrics.notify('deferred_enrichments_backlog', len(self._backlog))
@@ -10,16 +10,30 @@ from happybase import NoConnectionsAvailable
 from retry import retry
 from thriftpy2.protocol.exc import TException
 
+from modules.circuit_breaker import CircuitBreaker, CircuitBreakerOpenError
+
 logger = logging.getLogger('thehive_incidents_pusher')
 
+HBASE_ERRORS = (NoConnectionsAvailable, TException, socket.timeout)
+
+
+class HbaseUnavailableError(Exception):
+    pass
+
 
 class HbaseEventsLoader:
     def __init__(self, hbase_pool: happybase.ConnectionPool, namespace: str, raw_table_name: str,
-                 normalized_table_name: str):
+                 normalized_table_name: str, raw_circuit_breaker: CircuitBreaker = None,
+                 normalized_circuit_breaker: CircuitBreaker = None):
         self.hbase_pool = hbase_pool
         self.namespace = namespace
         self.raw_table_name = raw_table_name
         self.normalized_table_name = normalized_table_name
+        # Tables fail independently: a broken raw table must not block loading of normalized events
+        self.raw_circuit_breaker = raw_circuit_breaker or \
+            CircuitBreaker('hbase_raw', expected_exceptions=HBASE_ERRORS)
+        self.normalized_circuit_breaker = normalized_circuit_breaker or \
+            CircuitBreaker('hbase_normalized', expected_exceptions=HBASE_ERRORS)
 
     def _full_table_name(self, table_name: str) -> str:
         return f'{self.namespace}:{table_name}'
@@ -33,22 +47,25 @@ class HbaseEventsLoader:
         return self._full_table_name(self.normalized_table_name)
 
     def get_raw_events(self, event_ids: List[str]) -> List[str]:
-        try:
-            result = self._get_events_from_hbase(event_ids, self.full_raw_table_name)
-        except (NoConnectionsAvailable, TException, socket.timeout) as err:
-            result = []
-            pass
+        result = self._get_events(event_ids, self.full_raw_table_name, self.raw_circuit_breaker)
         return [self._raw_event_deserializer(item) for item in result]
 
     def get_normalized_events(self, event_ids: List[str]) -> List[SocEvent]:
-        try:
-            result = self._get_events_from_hbase(event_ids, self.full_normalized_table_name)
-        except (NoConnectionsAvailable, TException, socket.timeout) as err:
-            result = []
-            pass
+        result = self._get_events(event_ids, self.full_normalized_table_name, self.normalized_circuit_breaker)
         return [self._normalized_event_deserializer(item) for item in result]
 
-    @retry((NoConnectionsAvailable, TException, socket.timeout), tries=3, delay=1)
+    def _get_events(self, event_ids: List[str], full_table_name: str,
+                    circuit_breaker: CircuitBreaker) -> List[bytes]:
+        if not event_ids:
+            return []
+        try:
+            return circuit_breaker.call(self._get_events_from_hbase, event_ids, full_table_name)
+        except CircuitBreakerOpenError as err:
+            raise HbaseUnavailableError(str(err)) from err
+        except HBASE_ERRORS as err:
+            raise HbaseUnavailableError(f"HBase request failed: {err}") from err
+
+    @retry(HBASE_ERRORS, tries=3, delay=1)
     def _get_events_from_hbase(self, event_ids: List[str], full_table_name: str) -> List[bytes]:
         if not event_ids:
             return []
@@ -57,7 +74,7 @@ class HbaseEventsLoader:
                 table = conn.table(full_table_name)
                 table.scan()
                 result = table.rows([event_id.encode() for event_id in event_ids], columns=[b'n:e'])
-        except (NoConnectionsAvailable, TException, socket.timeout) as err:
+        except HBASE_ERRORS as err:
             logger.warning("HBase request raised an error: %s", str(err))
             metrics.notify("hbase_errors", 1)
             raise err
@@ -0,0 +1,138 @@
+import logging
+import os
+import tempfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from typing import List, Iterator
+
+from appmetrics import metrics
+
+logger = logging.getLogger('thehive_incidents_pusher')
+
+INCIDENT_EVENTS_COUNT_BUCKETS = (10, 100, 1000, 10000)
+SNAPSHOT_KEY_TYPES = ('lineno', 'filename', 'traceback')
+
+
+def incident_peak_memory_metric_name(events_count: int) -> str:
+    for bucket in INCIDENT_EVENTS_COUNT_BUCKETS:
+        if events_count <= bucket:
+            return f'incident_peak_memory_events_le_{bucket}'
+    return f'incident_peak_memory_events_gt_{INCIDENT_EVENTS_COUNT_BUCKETS[-1]}'
+
+
+def incident_peak_memory_metric_names() -> List[str]:
+    return [incident_peak_memory_metric_name(bucket) for bucket in INCIDENT_EVENTS_COUNT_BUCKETS] + \
+           [incident_peak_memory_metric_name(INCIDENT_EVENTS_COUNT_BUCKETS[-1] + 1)]
+
+
+class IncidentMemoryUsage:
+    def __init__(self):
+        self.events_count = 0
+        self.peak = 0
+
+
+class TracedMemorySampler(threading.Thread):
+    # Fallback for interpreters without tracemalloc.reset_peak, misses spikes shorter than the interval
+    def __init__(self, interval: float):
+        super().__init__(name='traced_memory_sampler', daemon=True)
+        self.interval = interval
+        self.peak, _ = tracemalloc.get_traced_memory()
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def stop(self) -> int:
+        self._stopped.set()
+        self.join()
+        self._sample()
+        return self.peak
+
+    def _sample(self) -> None:
+        current, _ = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, current)
+
+
+class MemoryProfiler:
+    """
+    Opt-in memory instrumentation based on tracemalloc.
+
+    When disabled, every method is a cheap no-op, so the profiler can always be passed around.
+    Per-incident peaks come from `tracemalloc.reset_peak` on Python 3.9+. Older interpreters can't reset
+    the peak without clearing all traces, so a sampler thread polls the traced memory every
+    `peak_sample_interval` seconds while the incident is processed.
+    """
+
+    def __init__(self, enabled: bool = False, frames: int = 1, top_limit: int = 25,
+                 peak_sample_interval: float = 0.01):
+        self.enabled = enabled
+        self.frames = frames
+        self.top_limit = top_limit
+        self.peak_sample_interval = peak_sample_interval
+        self._lock = threading.Lock()
+        self._baseline = None
+        self._previous = None
+        self.sample_peaks = self.enabled and not hasattr(tracemalloc, 'reset_peak')
+        if self.sample_peaks:
+            logger.info("tracemalloc.reset_peak is not available, sample peak memory every %s s",
+                        self.peak_sample_interval)
+        if self.enabled:
+            tracemalloc.start(self.frames)
+            self._baseline = self._previous = self.take_snapshot()
+            logger.info("Memory profiling is enabled, tracemalloc keeps %s frames", self.frames)
+
+    @staticmethod
+    def take_snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    def dump_snapshot(self) -> bytes:
+        if not self.enabled:
+            return b''
+        snapshot = self.take_snapshot()
+        fd, path = tempfile.mkstemp(suffix='.tracemalloc')
+        try:
+            os.close(fd)
+            snapshot.dump(path)
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+    def top_allocations_diff(self, key_type: str = 'lineno', since_baseline: bool = False) -> List[str]:
+        if not self.enabled:
+            return []
+        with self._lock:
+            snapshot = self.take_snapshot()
+            stats = snapshot.compare_to(self._baseline if since_baseline else self._previous, key_type)
+            self._previous = snapshot
+        return [str(stat) for stat in stats[:self.top_limit]]
+
+    @contextmanager
+    def track_incident(self) -> Iterator[IncidentMemoryUsage]:
+        usage = IncidentMemoryUsage()
+        if not self.enabled:
+            yield usage
+            return
+        sampler = None
+        if self.sample_peaks:
+            sampler = TracedMemorySampler(self.peak_sample_interval)
+            sampler.start()
+        else:
+            tracemalloc.reset_peak()
+        started_with, _ = tracemalloc.get_traced_memory()
+        try:
+            yield usage
+        finally:
+            if sampler is not None:
+                peak = sampler.stop()
+            else:
+                _, peak = tracemalloc.get_traced_memory()
+            usage.peak = max(peak - started_with, 0)
+            metrics.notify(incident_peak_memory_metric_name(usage.events_count), usage.peak)
+            logger.info("Incident with %s events took %s bytes of memory at peak", usage.events_count, usage.peak)
@@ -1,40 +1,66 @@
 import logging
-from typing import Dict, NoReturn, List
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, NoReturn, List, Optional, Tuple
 
 from appmetrics import metrics
 from common_proto.incident_pb2 import Incident
 from common_proto.normalized_event_pb2 import SocEvent
-from common_proto.raw_event_pb2 import RawEvent
 from google.protobuf.json_format import ParseDict, ParseError
 from requests import HTTPError
 from retry import retry
 from thehive4py.exceptions import TheHiveException
 from thehive4py.models import Alert, Case
+from thehive4py.query import And, Eq
 
+from modules.adaptive_limiter import AdaptiveLimiter
+from modules.alert_index import AlertIndex
+from modules.circuit_breaker import CircuitBreaker
 from modules.custom_thehive_api import CustomTheHiveApi
 from modules.db import hbase_pool
-from modules.hbase_event_loader import HbaseEventsLoader
+from modules.deferred_enrichment import INCIDENT, DeferredEnrichmentWorker
+from modules.hbase_event_loader import HbaseEventsLoader, HbaseUnavailableError, HBASE_ERRORS
+from modules.memory_profiler import IncidentMemoryUsage, MemoryProfiler
 from modules.soc_event_parser import SocEventParser
 
 logger = logging.getLogger('thehive_incidents_pusher')
 
 
 class TheHivePusher:
-    def __init__(self, thehive_settings: Dict, hbase_event_loader_settings: Dict):
+    def __init__(self, thehive_settings: Dict, hbase_event_loader_settings: Dict, thehive_limiter_settings: Dict = None,
+                 memory_profiler: MemoryProfiler = None, alert_index_settings: Dict = None):
         logger.info("Create THive API client with settings: %s", str(thehive_settings))
         self.api = CustomTheHiveApi(**thehive_settings)
+        self.limiter = AdaptiveLimiter(**(thehive_limiter_settings or {}))
+        # Alerts of an incident are pushed concurrently, the limiter decides how many requests are in flight
+        self.alert_sender = ThreadPoolExecutor(max_workers=self.limiter.max_limit, thread_name_prefix='alert_sender')
+        self.memory_profiler = memory_profiler or MemoryProfiler()
+        self.alert_index = AlertIndex(**(alert_index_settings or {}))
         self.hbase_event_loader = HbaseEventsLoader(
             hbase_pool,
             hbase_event_loader_settings['namespace'],
             hbase_event_loader_settings['raw_table_name'],
-            hbase_event_loader_settings['normalized_table_name']
+            hbase_event_loader_settings['normalized_table_name'],
+            CircuitBreaker('hbase_raw', expected_exceptions=HBASE_ERRORS,
+                           **hbase_event_loader_settings.get('circuit_breaker', {})),
+            CircuitBreaker('hbase_normalized', expected_exceptions=HBASE_ERRORS,
+                           **hbase_event_loader_settings.get('circuit_breaker', {}))
         )
+        self.deferred_enrichment = DeferredEnrichmentWorker(
+            self.api, self.limiter, self.hbase_event_loader,
+            incident_alerts_pusher=self.push_deferred_incident_alerts,
+            **hbase_event_loader_settings.get('deferred_enrichment', {})
+        )
+
+    def close(self) -> None:
+        self.alert_sender.shutdown()
+        self.deferred_enrichment.close()
+        self.alert_index.close()
 
     @retry((TheHiveException, HTTPError), tries=5, delay=2)
     @metrics.with_histogram("send_alert", reservoir_type='sliding_time_window')
     def send_alert(self, alert: Alert) -> Dict:
         try:
-            response = self.api.create_alert(alert)
+            response = self.limiter.call(self.api.create_alert, alert)
             response.raise_for_status()
         except (TheHiveException, HTTPError) as exc:
             metrics.notify('thehive_api_errors', 1)
@@ -45,7 +71,7 @@ class TheHivePusher:
     @retry((TheHiveException, HTTPError), tries=5, delay=2)
     def create_case_from_alert(self, alert_id: str) -> NoReturn:
         try:
-            self.api.promote_alert_to_case(alert_id)
+            self.limiter.call(self.api.promote_alert_to_case, alert_id)
         except (TheHiveException, HTTPError) as exc:
             metrics.notify('thehive_api_errors', 1)
             logger.error("TheHive create case from alert error: %s", str(exc))
@@ -55,7 +81,7 @@ class TheHivePusher:
     @metrics.with_histogram("create_case", reservoir_type='sliding_time_window')
     def create_case(self, case: Case) -> Dict:
         try:
-            response = self.api.create_case(case)
+            response = self.limiter.call(self.api.create_case, case)
             response.raise_for_status()
         except (TheHiveException, HTTPError) as exc:
             metrics.notify('thehive_api_errors', 1)
@@ -67,7 +93,7 @@ class TheHivePusher:
     @metrics.with_histogram("merge_alerts_in_case", reservoir_type='sliding_time_window')
     def merge_alerts_in_case(self, case_id: str, alert_ids: List[str]) -> Dict:
         try:
-            response = self.api.merge_alerts_into_case(case_id, alert_ids)
+            response = self.limiter.call(self.api.merge_alerts_into_case, case_id, alert_ids)
             response.raise_for_status()
         except (TheHiveException, HTTPError) as exc:
             metrics.notify('thehive_api_errors', 1)
@@ -80,7 +106,7 @@ class TheHivePusher:
     def set_final_tag(self, case: Case) -> Dict:
         case.tags.append('FINAL')
         try:
-            response = self.api.update_case(case, fields=['tags'])
+            response = self.limiter.call(self.api.update_case, case, fields=['tags'])
             response.raise_for_status()
         except (TheHiveException, HTTPError) as exc:
             metrics.notify('thehive_api_errors', 1)
@@ -90,6 +116,10 @@ class TheHivePusher:
 
     @metrics.with_histogram("full_processing_time", reservoir_type='sliding_time_window')
     def push(self, message: Dict):
+        with self.memory_profiler.track_incident() as incident_memory:
+            self._push(message, incident_memory)
+
+    def _push(self, message: Dict, incident_memory: IncidentMemoryUsage):
         with metrics.timer("thehive_case_preparing", reservoir_type='sliding_time_window'):
             try:
                 ea_incident = ParseDict(message, Incident(), ignore_unknown_fields=True)
@@ -98,36 +128,127 @@ class TheHivePusher:
                 return
             case = SocEventParser.prepare_thehive_case(ea_incident)
             raw_events = self.load_raw_events(ea_incident)
-            case.customFields.update({'raw': {'string': ';\n'.join(raw_events), 'order': len(case.customFields)}})
+            if raw_events is not None:
+                case.customFields.update({'raw': {'string': ';\n'.join(raw_events), 'order': len(case.customFields)}})
+
+        normalized_events = self.load_normalized_events(ea_incident)
+        incident_memory.events_count = len(normalized_events or [])
+
         r = self.create_case(case)
         case.id = r['id']
         metrics.notify('created_thehive_cases', 1)
         logger.info("Successfully create case from event into THive: %s", str(r))
+        if raw_events is None:
+            self.deferred_enrichment.defer('case', case.id, ea_incident.correlationEvent.data.rawIds,
+                                           len(case.customFields))
 
-        normalized_events = self.load_normalized_events(ea_incident)
+        if normalized_events is None:
+            # The case stays without FINAL tag until its alerts are pushed by the deferred enrichment worker
+            self.deferred_enrichment.defer(
+                INCIDENT, case.id, [item.value for item in ea_incident.correlationEvent.correlation.eventIds],
+                tags=case.tags
+            )
+        else:
+            self._push_incident_alerts(case.id, normalized_events)
+            self.set_final_tag(case)
 
+        logger.info("Successfully process ea message")
+        metrics.notify("successfully_processed_messages", 1)
+
+    def push_deferred_incident_alerts(self, case_id: str, event_ids: List[str], tags: List[str]) -> NoReturn:
+        normalized_events = self.hbase_event_loader.get_normalized_events(event_ids)
+        self._push_incident_alerts(case_id, normalized_events)
+        case = Case(tags=list(tags))
+        case.id = case_id
+        self.set_final_tag(case)
+
+    def _push_incident_alerts(self, case_id: str, normalized_events: List[SocEvent]) -> NoReturn:
         alert_ids = []
+        indexed_events = {}
+        pushed_alerts = []
         for event in normalized_events:
-            alert = self._prepare_alert_from_event(event)
-            logger.info("Try to send alert to theHive: %s", str(alert))
-            try:
-                r = self.send_alert(alert)
-            except HTTPError as err:
-                if err.response.status_code == 400:
-                    continue
+            known_alert_id = self.alert_index.get(event.id)
+            if known_alert_id is not None:
+                logger.info("Alert for event %s is already pushed to TheHive: %s", event.id, known_alert_id)
+                metrics.notify('alert_index_skipped_alerts', 1)
+                indexed_events[known_alert_id] = event
+                alert_ids.append(known_alert_id)
+                continue
+            pushed_alerts.append(self.alert_sender.submit(self._push_alert, event))
+
+        wait(pushed_alerts)
+        for future in pushed_alerts:
+            alert_id = future.result()
+            if alert_id is not None:
+                alert_ids.append(alert_id)
+
+        if alert_ids:
+            self._merge_alerts(case_id, alert_ids, indexed_events)
+
+    def _push_alert(self, event: SocEvent) -> Optional[str]:
+        alert, raw_deferred = self._prepare_alert_from_event(event)
+        logger.info("Try to send alert to theHive: %s", str(alert))
+        try:
+            r = self.send_alert(alert)
+        except HTTPError as err:
+            if err.response.status_code == 400:
+                return self._find_existing_alert_id(alert)
+            raise err
+        logger.info("Successfully push alert to THive: %s", str(r))
+        metrics.notify('created_thehive_alerts', 1)
+        self.alert_index.add(alert.sourceRef, r['id'])
+        if raw_deferred:
+            self.deferred_enrichment.defer('alert', r['id'], event.data.rawIds, len(alert.customFields))
+        return r['id']
+
+    def _find_existing_alert_id(self, alert: Alert) -> Optional[str]:
+        # Events pushed before the index was enabled are looked up once and remembered
+        if not self.alert_index.enabled:
+            return None
+        query = And(Eq('sourceRef', alert.sourceRef), Eq('source', alert.source), Eq('type', alert.type))
+        try:
+            response = self.limiter.call(self.api.find_alerts, query=query, range='0-1')
+            response.raise_for_status()
+        except (TheHiveException, HTTPError) as exc:
+            metrics.notify('thehive_api_errors', 1)
+            logger.warning("TheHive find alert by sourceRef error: %s", str(exc))
+            return None
+        alerts = response.json()
+        if not alerts:
+            return None
+        self.alert_index.add(alert.sourceRef, alerts[0]['id'])
+        return alerts[0]['id']
+
+    def _merge_alerts(self, case_id: str, alert_ids: List[str], indexed_events: Dict[str, SocEvent]) -> NoReturn:
+        try:
+            self.merge_alerts_in_case(case_id, alert_ids)
+            return
+        except HTTPError as err:
+            if not indexed_events or err.response.status_code >= 500:
                 raise err
-            logger.info("Successfully push alert to THive: %s", str(r))
-            metrics.notify('created_thehive_alerts', 1)
-            alert_ids.append(r['id'])
+            logger.warning("Merge alerts failed, check alerts taken from the index: %s", str(err))
 
+        alert_ids = list(alert_ids)
+        for alert_id, event in indexed_events.items():
+            if self._alert_exists(alert_id):
+                continue
+            logger.warning("Alert %s of event %s is not found in TheHive, push it again", alert_id, event.id)
+            self.alert_index.remove(event.id)
+            alert_ids.remove(alert_id)
+            new_alert_id = self._push_alert(event)
+            if new_alert_id is not None:
+                alert_ids.append(new_alert_id)
         if alert_ids:
-            self.merge_alerts_in_case(case.id, alert_ids)
-        self.set_final_tag(case)
+            self.merge_alerts_in_case(case_id, alert_ids)
 
-        logger.info("Successfully process ea message")
-        metrics.notify("successfully_processed_messages", 1)
+    def _alert_exists(self, alert_id: str) -> bool:
+        response = self.limiter.call(self.api.get_alert, alert_id)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
 
-    def load_normalized_events(self, incident: Incident) -> List[SocEvent]:
+    def load_normalized_events(self, incident: Incident) -> Optional[List[SocEvent]]:
         logger.info("Try to get normalized events from HBase")
         with metrics.timer("hbase_loading_time", reservoir_type='sliding_time_window'):
             try:
@@ -136,6 +257,9 @@ class TheHivePusher:
                 )
                 logger.info("Receive normalized events: %s", len(normalized_events))
                 metrics.notify("loaded_hbase_normalized_events", len(normalized_events))
+            except HbaseUnavailableError as err:
+                logger.warning("HBase is unavailable, alerts will be pushed later: %s", str(err))
+                normalized_events = None
             except Exception as err:
                 metrics.notify('hbase_errors', 1)
                 logger.warning("Some unknown exception have been raised by HBaseEventLoader: %s", str(err))
@@ -143,7 +267,7 @@ class TheHivePusher:
                 pass
         return normalized_events
 
-    def load_raw_events(self, incident: Incident) -> List[RawEvent]:
+    def load_raw_events(self, incident: Incident) -> Optional[List[str]]:
         logger.info("Try to get raw events from HBase")
         with metrics.timer("hbase_loading_time", reservoir_type='sliding_time_window'):
             try:
@@ -152,6 +276,9 @@ class TheHivePusher:
                 )
                 logger.info("Receive raw events: %s", len(raw_events))
                 metrics.notify("loaded_hbase_raw_events", len(raw_events))
+            except HbaseUnavailableError as err:
+                logger.warning("HBase is unavailable, raw events will be loaded later: %s", str(err))
+                raw_events = None
             except Exception as err:
                 metrics.notify('hbase_errors', 1)
                 logger.warning("Some unknown exception have been raised by HBaseEventLoader: %s", str(err))
@@ -159,7 +286,7 @@ class TheHivePusher:
                 pass
         return raw_events
 
-    def _prepare_alert_from_event(self, event: SocEvent) -> Alert:
+    def _prepare_alert_from_event(self, event: SocEvent) -> Tuple[Alert, bool]:
         logger.info("Parse message with SocEventParser: %s", str(event.id))
         with metrics.timer("thehive_alert_preparing", reservoir_type='sliding_time_window'):
             alert = SocEventParser.prepare_thehive_alert(event)
@@ -173,9 +300,12 @@ class TheHivePusher:
                     {'raw': {'string': ';\n'.join(raw_logs), 'order': len(alert.customFields)}}
                 )
                 metrics.notify("enriched_by_hbase_alerts", 1)
+            except HbaseUnavailableError as err:
+                logger.warning("HBase is unavailable, alert will be enriched later: %s", str(err))
+                return alert, True
             except Exception as err:
                 # TODO: specify type of exceptions that should be caught
                 metrics.notify('hbase_errors', 1)
                 logger.warning("Some exception have been raised by HBaseEnricher: %s", str(err))
                 pass
-        return alert
+        return alert, False
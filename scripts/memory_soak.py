@@ -0,0 +1,148 @@
+"""
+Soak test for memory usage of TheHivePusher.
+
+Pushes synthetic incidents through the pusher with fake TheHive API and HBase loader and fails
+(exit code 1) if memory allocated from the pusher code keeps growing after the warm up. Samples kept by
+appmetrics reservoirs for their time window are excluded, they are bounded by the window and not a leak.
+
+    python scripts/memory_soak.py --incidents 500 --events 200 --max-growth 5242880
+"""
+import argparse
+import gc
+import logging
+import os
+import sys
+import tempfile
+import tracemalloc
+import types
+from typing import Dict, List
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+# modules.db creates HBase pool from settings file on import, fakes don't need it
+sys.modules.setdefault('modules.db', types.ModuleType('modules.db'))
+sys.modules['modules.db'].hbase_pool = None
+
+from common_proto.normalized_event_pb2 import SocEvent  # noqa: E402
+
+from modules.app_metrics import register_app_metrics  # noqa: E402
+from modules.pusher import TheHivePusher  # noqa: E402
+
+logger = logging.getLogger('thehive_incidents_pusher')
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, data: Dict):
+        self._data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self) -> Dict:
+        return self._data
+
+
+class FakeTheHiveApi:
+    def __init__(self):
+        self._next_id = 0
+
+    def _response(self) -> FakeResponse:
+        self._next_id += 1
+        return FakeResponse({'id': str(self._next_id)})
+
+    def create_alert(self, alert) -> FakeResponse:
+        return self._response()
+
+    def create_case(self, case) -> FakeResponse:
+        return self._response()
+
+    def merge_alerts_into_case(self, case_id: str, alert_ids: List[str]) -> FakeResponse:
+        return self._response()
+
+    def update_case(self, case, fields: List[str] = None) -> FakeResponse:
+        return self._response()
+
+
+class FakeHbaseEventsLoader:
+    def __init__(self, raw_size: int):
+        self.raw_size = raw_size
+
+    def get_raw_events(self, event_ids: List[str]) -> List[str]:
+        return ['x' * self.raw_size for _ in event_ids]
+
+    def get_normalized_events(self, event_ids: List[str]) -> List[SocEvent]:
+        events = []
+        for event_id in event_ids:
+            event = SocEvent(id=event_id)
+            event.data.rawIds.append(f'raw-{event_id}')
+            events.append(event)
+        return events
+
+
+def synthetic_incident(number: int, events_count: int) -> Dict:
+    return {
+        'id': f'soak-{number}',
+        'usecaseId': 'soak_test',
+        'correlationEvent': {
+            'correlation': {'eventIds': [{'value': f'soak-{number}-{i}'} for i in range(events_count)]},
+            'data': {'rawIds': [f'soak-{number}-raw']},
+        },
+    }
+
+
+def take_pusher_snapshot() -> tracemalloc.Snapshot:
+    gc.collect()
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(True, os.path.join(PROJECT_DIR, 'modules', '*'), all_frames=True),
+        tracemalloc.Filter(False, '*/appmetrics/*', all_frames=True),
+    ))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--incidents', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--events', type=int, default=100, help="normalized events per incident")
+    parser.add_argument('--raw-size', type=int, default=4096, help="size of every raw log in bytes")
+    parser.add_argument('--max-growth', type=int, default=5 * 1024 * 1024,
+                        help="allowed growth of memory allocated from pusher code after warm up in bytes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    register_app_metrics()
+    storage_dir = tempfile.mkdtemp(prefix='memory_soak_')
+    pusher = TheHivePusher({'url': 'http://thehive.fake', 'principal': 'fake'},
+                           {'namespace': 'fake', 'raw_table_name': 'raw', 'normalized_table_name': 'norm',
+                            'deferred_enrichment': {'path': os.path.join(storage_dir, 'deferred_enrichments')}})
+    pusher.api = FakeTheHiveApi()
+    pusher.hbase_event_loader = FakeHbaseEventsLoader(args.raw_size)
+
+    # deep tracebacks let allocations made by libraries on behalf of the pusher be attributed to it
+    tracemalloc.start(25)
+    baseline = None
+    for number in range(args.warmup + args.incidents):
+        if number == args.warmup:
+            baseline = take_pusher_snapshot()
+        pusher.push(synthetic_incident(number, args.events))
+    current = take_pusher_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = current.compare_to(baseline, 'traceback')
+    growth = sum(stat.size_diff for stat in stats)
+    print(f"peak={peak} growth={growth} max_growth={args.max_growth}")
+    if growth > args.max_growth:
+        print("FAIL: memory grows unbounded during soak test, top allocations:")
+        for stat in stats[:10]:
+            print(stat)
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
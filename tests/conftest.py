@@ -0,0 +1,8 @@
+import pytest
+
+from modules.app_metrics import register_app_metrics
+
+
+@pytest.fixture(scope='session', autouse=True)
+def app_metrics():
+    register_app_metrics()
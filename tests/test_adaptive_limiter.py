@@ -0,0 +1,122 @@
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+import requests
+from thehive4py.exceptions import TheHiveException
+
+from modules.adaptive_limiter import AdaptiveLimiter, LimiterRejectedError
+
+
+def make_response(status_code: int, headers: dict = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+def test_limit_grows_additively_while_latency_is_healthy():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=8)
+    for _ in range(3):
+        limiter.call(make_response, 200)
+    assert limiter.limit == 3
+    assert limiter.in_flight == 0
+
+
+def test_limit_does_not_exceed_max_limit():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=2)
+    for _ in range(10):
+        limiter.call(make_response, 200)
+    assert limiter.limit == 2
+
+
+@pytest.mark.parametrize('status_code', [429, 500, 503])
+def test_limit_is_cut_on_overload_responses(status_code):
+    limiter = AdaptiveLimiter(initial_limit=8, backoff_ratio=0.5, default_retry_after=0)
+    response = limiter.call(make_response, status_code)
+    assert response.status_code == status_code
+    assert limiter.limit == 4
+
+
+def test_limit_is_cut_on_slow_responses():
+    limiter = AdaptiveLimiter(initial_limit=8, latency_threshold=0.01)
+    limiter.call(lambda: time.sleep(0.05) or make_response(200))
+    assert limiter.limit == 4
+
+
+def test_limit_is_not_cut_below_min_limit():
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=2, default_retry_after=0)
+    for _ in range(5):
+        limiter.call(make_response, 503)
+    assert limiter.limit == 2
+
+
+def test_limit_is_cut_on_timeouts():
+    def timeout():
+        raise requests.Timeout()
+
+    limiter = AdaptiveLimiter(initial_limit=8)
+    with pytest.raises(requests.Timeout):
+        limiter.call(timeout)
+    assert limiter.limit == 4
+
+
+def test_limit_is_cut_on_timeouts_wrapped_by_thehive4py():
+    def wrapped_timeout():
+        try:
+            raise requests.Timeout()
+        except requests.RequestException as e:
+            raise TheHiveException("Error: {}".format(e))
+
+    limiter = AdaptiveLimiter(initial_limit=8)
+    with pytest.raises(TheHiveException):
+        limiter.call(wrapped_timeout)
+    assert limiter.limit == 4
+
+
+def test_retry_after_pauses_next_requests():
+    limiter = AdaptiveLimiter()
+    limiter.call(make_response, 429, {'Retry-After': '0.2'})
+    started_at = time.monotonic()
+    limiter.call(make_response, 200)
+    assert time.monotonic() - started_at >= 0.2
+
+
+def test_retry_after_as_http_date():
+    response = make_response(503, {'Retry-After': formatdate(time.time() + 30, usegmt=True)})
+    assert 25 < AdaptiveLimiter._parse_retry_after(response) <= 30
+
+
+def test_unparsable_retry_after_is_ignored():
+    assert AdaptiveLimiter._parse_retry_after(make_response(503, {'Retry-After': 'soon'})) is None
+
+
+def test_request_is_rejected_after_max_queue_wait():
+    limiter = AdaptiveLimiter(max_queue_wait=0.1)
+    limiter.call(make_response, 429, {'Retry-After': '10'})
+    with pytest.raises(LimiterRejectedError):
+        limiter.call(make_response, 200)
+
+
+def test_in_flight_requests_are_bounded_by_limit():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=2)
+    lock = threading.Lock()
+    in_flight = []
+    max_in_flight = []
+
+    def request():
+        with lock:
+            in_flight.append(1)
+            max_in_flight.append(len(in_flight))
+        time.sleep(0.02)
+        with lock:
+            in_flight.pop()
+        return make_response(200)
+
+    threads = [threading.Thread(target=limiter.call, args=(request,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(max_in_flight) <= 2
@@ -0,0 +1,90 @@
+import os
+
+from modules.alert_index import AlertIndex, BloomFilter
+
+
+def make_index(tmp_path, **kwargs) -> AlertIndex:
+    return AlertIndex(enabled=True, path=os.path.join(str(tmp_path), 'alert_index'), **kwargs)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom_filter = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom_filter.add(f'event-{i}')
+    assert all(f'event-{i}' in bloom_filter for i in range(1000))
+    assert bloom_filter.items_count == 1000
+
+
+def test_bloom_filter_false_positive_rate_is_near_target():
+    bloom_filter = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom_filter.add(f'event-{i}')
+    false_positives = sum(f'unknown-{i}' in bloom_filter for i in range(10000))
+    assert false_positives / 10000 < 0.03
+    assert 0.005 < bloom_filter.estimated_false_positive_rate < 0.02
+
+
+def test_disabled_index_finds_nothing():
+    index = AlertIndex()
+    index.add('event-1', 'alert-1')
+    assert index.get('event-1') is None
+    assert index.size == 0
+
+
+def test_index_returns_added_alert_ids(tmp_path):
+    index = make_index(tmp_path)
+    index.add('event-1', 'alert-1')
+    assert index.get('event-1') == 'alert-1'
+    assert index.get('event-2') is None
+    assert index.size == 1
+    index.close()
+
+
+def test_index_persists_across_reopen(tmp_path):
+    index = make_index(tmp_path)
+    index.add('event-1', 'alert-1')
+    index.add('event-2', 'alert-2')
+    index.close()
+
+    index = make_index(tmp_path)
+    assert index.size == 2
+    assert index.get('event-1') == 'alert-1'
+    assert index.get('event-2') == 'alert-2'
+    index.close()
+
+
+def test_removed_entry_is_not_found(tmp_path):
+    index = make_index(tmp_path)
+    index.add('event-1', 'alert-1')
+    index.remove('event-1')
+    assert index.get('event-1') is None
+    index.close()
+
+    index = make_index(tmp_path)
+    assert index.get('event-1') is None
+    index.close()
+
+
+def test_readding_known_source_ref_updates_alert_id(tmp_path):
+    index = make_index(tmp_path)
+    index.add('event-1', 'alert-1')
+    index.add('event-1', 'alert-2')
+    assert index.get('event-1') == 'alert-2'
+    assert index.size == 1
+    index.close()
+
+
+def test_size_follows_removed_and_readded_entries(tmp_path):
+    index = make_index(tmp_path)
+    index.add('event-1', 'alert-1')
+    index.add('event-2', 'alert-2')
+    index.remove('event-1')
+    index.remove('event-1')
+    assert index.size == 1
+    index.add('event-1', 'alert-3')
+    assert index.size == 2
+    index.close()
+
+    index = make_index(tmp_path)
+    assert index.size == 2
+    index.close()
@@ -0,0 +1,135 @@
+import time
+
+import pytest
+from appmetrics import metrics
+
+from modules.circuit_breaker import CircuitBreaker, CircuitBreakerOpenError
+
+
+class HbaseDown(Exception):
+    pass
+
+
+def fail():
+    raise HbaseDown()
+
+
+def succeed():
+    return 'ok'
+
+
+def make_breaker(**kwargs) -> CircuitBreaker:
+    settings = dict(window_size=4, min_calls=4, failure_rate_threshold=0.5, recovery_timeout=0.05,
+                    expected_exceptions=(HbaseDown,))
+    settings.update(kwargs)
+    return CircuitBreaker('hbase_raw', **settings)
+
+
+def call_ignoring_errors(breaker: CircuitBreaker, func):
+    try:
+        breaker.call(func)
+    except HbaseDown:
+        pass
+
+
+def test_breaker_opens_when_failure_rate_reaches_threshold():
+    breaker = make_breaker()
+    for func in (succeed, fail, succeed, fail):
+        call_ignoring_errors(breaker, func)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_breaker_stays_closed_below_min_calls():
+    breaker = make_breaker()
+    for _ in range(3):
+        call_ignoring_errors(breaker, fail)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_stays_closed_below_threshold():
+    breaker = make_breaker()
+    for func in (succeed, succeed, succeed, fail):
+        call_ignoring_errors(breaker, func)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_breaker_fails_fast_without_calling():
+    calls = []
+    breaker = make_breaker(min_calls=1, window_size=1, recovery_timeout=60)
+    call_ignoring_errors(breaker, fail)
+    with pytest.raises(CircuitBreakerOpenError):
+        breaker.call(lambda: calls.append(1))
+    assert calls == []
+
+
+def test_successful_probe_closes_breaker():
+    breaker = make_breaker(min_calls=1, window_size=1)
+    call_ignoring_errors(breaker, fail)
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.call(succeed) == 'ok'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_opens_breaker_again():
+    breaker = make_breaker(min_calls=1, window_size=1)
+    call_ignoring_errors(breaker, fail)
+    time.sleep(0.06)
+    call_ignoring_errors(breaker, fail)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_breaker_lets_single_probe_through():
+    breaker = make_breaker(min_calls=1, window_size=1)
+    call_ignoring_errors(breaker, fail)
+    time.sleep(0.06)
+
+    def probe():
+        with pytest.raises(CircuitBreakerOpenError):
+            breaker.call(succeed)
+        return 'probe'
+
+    assert breaker.call(probe) == 'probe'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_unexpected_errors_are_not_counted():
+    breaker = make_breaker(min_calls=1, window_size=1)
+    with pytest.raises(ValueError):
+        breaker.call(int, 'not a number')
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_late_failures_do_not_postpone_probe():
+    breaker = make_breaker(min_calls=1, window_size=1)
+    late_results = []
+
+    def slow_failure():
+        # trip the breaker while this call is still in flight
+        call_ignoring_errors(breaker, fail)
+        time.sleep(0.06)
+        late_results.append(breaker.state)
+        raise HbaseDown()
+
+    call_ignoring_errors(breaker, slow_failure)
+    assert late_results == [CircuitBreaker.HALF_OPEN]
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_late_success_is_not_taken_for_probe_result():
+    breaker = make_breaker(min_calls=1, window_size=1)
+
+    def slow_success():
+        call_ignoring_errors(breaker, fail)
+        time.sleep(0.06)
+        return 'late'
+
+    assert breaker.call(slow_success) == 'late'
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_initial_state_is_reported():
+    breaker = make_breaker(min_calls=1, window_size=1, recovery_timeout=60)
+    call_ignoring_errors(breaker, fail)
+    make_breaker()
+    assert metrics.get('hbase_raw_circuit_breaker_state')['value'] == CircuitBreaker.CLOSED
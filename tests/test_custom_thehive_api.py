@@ -0,0 +1,64 @@
+import pytest
+import requests
+from thehive4py.exceptions import TheHiveException
+from thehive4py.models import Alert, Case
+
+from modules.custom_thehive_api import CustomTheHiveApi
+
+
+@pytest.fixture
+def api():
+    return CustomTheHiveApi('http://thehive.local', 'key', timeout=7)
+
+
+@pytest.fixture
+def sent_requests(monkeypatch):
+    sent = []
+
+    def send(method):
+        def request(url, **kwargs):
+            sent.append((method, url, kwargs))
+            response = requests.Response()
+            response.status_code = 200
+            return response
+        return request
+
+    for method in ('get', 'post', 'patch'):
+        monkeypatch.setattr(requests, method, send(method))
+    return sent
+
+
+def make_alert() -> Alert:
+    return Alert(title='t', description='d', type='type', source='source', sourceRef='ref')
+
+
+@pytest.mark.parametrize('call', [
+    lambda api: api.create_alert(make_alert()),
+    lambda api: api.create_case(Case(title='t', description='d')),
+    lambda api: api.update_case(Case(id='c1', tags=['FINAL']), fields=['tags']),
+    lambda api: api.get_alert('a1'),
+    lambda api: api.find_alerts(query={}, range='0-1'),
+    lambda api: api.promote_alert_to_case('a1'),
+    lambda api: api.merge_alerts_into_case('c1', ['a1']),
+    lambda api: api.update_custom_field('alert', 'a1', 'raw', {'string': 'raw'}),
+])
+def test_requests_are_sent_with_timeout(api, sent_requests, call):
+    call(api)
+    assert len(sent_requests) == 1
+    assert sent_requests[0][2]['timeout'] == 7
+
+
+def test_update_case_sends_only_requested_fields(api, sent_requests):
+    api.update_case(Case(id='c1', title='t', tags=['FINAL']), fields=['tags'])
+    method, url, kwargs = sent_requests[0]
+    assert (method, url, kwargs['json']) == ('patch', 'http://thehive.local/api/case/c1', {'tags': ['FINAL']})
+
+
+def test_timeout_is_wrapped_with_context(api, monkeypatch):
+    def timeout(*args, **kwargs):
+        raise requests.Timeout()
+
+    monkeypatch.setattr(requests, 'post', timeout)
+    with pytest.raises(TheHiveException) as exc_info:
+        api.create_alert(make_alert())
+    assert isinstance(exc_info.value.__context__, requests.Timeout)
@@ -0,0 +1,109 @@
+import os
+
+import requests
+
+from modules.adaptive_limiter import AdaptiveLimiter
+from modules.deferred_enrichment import DeferredEnrichmentWorker
+from modules.hbase_event_loader import HbaseUnavailableError
+
+
+class FakeHbaseEventsLoader:
+    def __init__(self, available: bool = True):
+        self.available = available
+
+    def get_raw_events(self, event_ids):
+        if not self.available:
+            raise HbaseUnavailableError("Circuit breaker hbase is open")
+        return [f'raw of {event_id}' for event_id in event_ids]
+
+    def get_normalized_events(self, event_ids):
+        if not self.available:
+            raise HbaseUnavailableError("Circuit breaker hbase_normalized is open")
+        return list(event_ids)
+
+
+class FakeTheHiveApi:
+    def __init__(self):
+        self.updates = []
+
+    def update_custom_field(self, entity_type, entity_id, name, value):
+        self.updates.append((entity_type, entity_id, name, value))
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+
+class FakeIncidentAlertsPusher:
+    def __init__(self, loader):
+        self.loader = loader
+        self.pushed = []
+
+    def __call__(self, case_id, event_ids, tags):
+        self.pushed.append((case_id, self.loader.get_normalized_events(event_ids), tags))
+
+
+def make_worker(path, loader, api=None, incident_alerts_pusher=None) -> DeferredEnrichmentWorker:
+    return DeferredEnrichmentWorker(api or FakeTheHiveApi(), AdaptiveLimiter(), loader, path=path,
+                                    incident_alerts_pusher=incident_alerts_pusher)
+
+
+def test_backlog_survives_restart(tmp_path):
+    path = os.path.join(str(tmp_path), 'deferred')
+    worker = make_worker(path, FakeHbaseEventsLoader())
+    worker.defer('alert', 'a1', ['r1'], 3)
+    worker.defer('case', 'c1', ['r2', 'r3'], 5)
+    worker.close()
+
+    worker = make_worker(path, FakeHbaseEventsLoader())
+    assert worker.backlog_size == 2
+    worker.close()
+
+
+def test_backlog_is_kept_while_hbase_is_unavailable(tmp_path):
+    api = FakeTheHiveApi()
+    worker = make_worker(os.path.join(str(tmp_path), 'deferred'), FakeHbaseEventsLoader(available=False), api)
+    worker.defer('alert', 'a1', ['r1'], 3)
+    worker.process_backlog()
+    assert worker.backlog_size == 1
+    assert api.updates == []
+    worker.close()
+
+
+def test_backlog_is_processed_when_hbase_recovers(tmp_path):
+    api = FakeTheHiveApi()
+    loader = FakeHbaseEventsLoader(available=False)
+    worker = make_worker(os.path.join(str(tmp_path), 'deferred'), loader, api)
+    worker.defer('alert', 'a1', ['r1'], 3)
+    worker.process_backlog()
+    loader.available = True
+    worker.process_backlog()
+    assert worker.backlog_size == 0
+    assert api.updates == [('alert', 'a1', 'raw', {'string': 'raw of r1', 'order': 3})]
+    worker.close()
+
+
+def test_full_backlog_rejects_new_items(tmp_path):
+    worker = make_worker(os.path.join(str(tmp_path), 'deferred'), FakeHbaseEventsLoader())
+    worker.max_backlog = 1
+    worker.defer('alert', 'a1', ['r1'], 3)
+    worker.defer('alert', 'a2', ['r2'], 3)
+    assert worker.backlog_size == 1
+    worker.close()
+
+
+def test_deferred_incident_is_pushed_when_hbase_recovers(tmp_path):
+    loader = FakeHbaseEventsLoader(available=False)
+    incident_alerts_pusher = FakeIncidentAlertsPusher(loader)
+    path = os.path.join(str(tmp_path), 'deferred')
+    worker = make_worker(path, loader, incident_alerts_pusher=incident_alerts_pusher)
+    worker.defer('incident', 'c1', ['e1', 'e2'], tags=['usecase'])
+    worker.process_backlog()
+    assert worker.backlog_size == 1
+    worker.close()
+
+    loader.available = True
+    worker = make_worker(path, loader, incident_alerts_pusher=incident_alerts_pusher)
+    worker.process_backlog()
+    assert worker.backlog_size == 0
+    assert incident_alerts_pusher.pushed == [('c1', ['e1', 'e2'], ['usecase'])]
+    worker.close()
@@ -0,0 +1,84 @@
+import os
+import tracemalloc
+
+import pytest
+from appmetrics import metrics
+from flask import Flask
+
+from modules.app_metrics import register_memory_profiling_routes
+from modules.memory_profiler import MemoryProfiler, incident_peak_memory_metric_name
+
+
+@pytest.fixture
+def profiler():
+    profiler = MemoryProfiler(enabled=True, frames=1, top_limit=5)
+    yield profiler
+    tracemalloc.stop()
+
+
+@pytest.fixture
+def client(profiler):
+    app = Flask(__name__)
+    register_memory_profiling_routes(app, profiler)
+    return app.test_client()
+
+
+def test_disabled_profiler_is_noop():
+    profiler = MemoryProfiler()
+    assert not tracemalloc.is_tracing()
+    assert profiler.dump_snapshot() == b''
+    assert profiler.top_allocations_diff() == []
+    with profiler.track_incident() as usage:
+        usage.events_count = 3
+    assert usage.peak == 0
+
+
+def test_dump_snapshot_can_be_loaded(profiler, tmp_path):
+    path = os.path.join(str(tmp_path), 'snapshot.tracemalloc')
+    with open(path, 'wb') as f:
+        f.write(profiler.dump_snapshot())
+    snapshot = tracemalloc.Snapshot.load(path)
+    assert snapshot.traceback_limit == 1
+
+
+def test_top_allocations_diff_shows_new_allocations(profiler):
+    profiler.top_allocations_diff()
+    allocated = [bytearray(1024) for _ in range(1000)]
+    top = profiler.top_allocations_diff()
+    assert 0 < len(top) <= 5
+    assert __file__ in top[0]
+    del allocated
+
+
+@pytest.mark.parametrize('sample_peaks', [False, True])
+def test_track_incident_measures_peak(profiler, sample_peaks):
+    if not sample_peaks and not hasattr(tracemalloc, 'reset_peak'):
+        pytest.skip("tracemalloc.reset_peak needs Python 3.9+")
+    profiler.sample_peaks = sample_peaks
+    name = incident_peak_memory_metric_name(10)
+    with profiler.track_incident() as usage:
+        usage.events_count = 10
+        allocated = [bytearray(1024) for _ in range(1000)]
+    del allocated
+    assert usage.peak >= 1024 * 1000
+    assert metrics.get(name)['max'] >= usage.peak
+
+
+def test_snapshot_route_returns_attachment(client):
+    response = client.get('/memory/snapshot')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/octet-stream'
+    assert 'snapshot.tracemalloc' in response.headers['Content-Disposition']
+    assert response.data
+
+
+def test_top_route_returns_allocations(client):
+    response = client.get('/memory/top?key_type=filename&since=baseline')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+
+
+def test_top_route_rejects_unknown_key_type(client):
+    response = client.get('/memory/top?key_type=function')
+    assert response.status_code == 400
+    assert b'lineno' in response.data
@@ -0,0 +1,187 @@
+import json
+import os
+import sys
+import threading
+import time
+import types
+from types import SimpleNamespace
+
+import pytest
+import requests
+import retry.api
+from thehive4py.models import Alert, Case
+
+# modules.db creates HBase pool from settings file on import, fakes don't need it
+sys.modules.setdefault('modules.db', types.ModuleType('modules.db'))
+sys.modules['modules.db'].hbase_pool = None
+
+import modules.pusher  # noqa: E402
+from modules.hbase_event_loader import HbaseUnavailableError  # noqa: E402
+from modules.pusher import TheHivePusher  # noqa: E402
+from modules.soc_event_parser import SocEventParser  # noqa: E402
+
+
+def make_response(status_code: int, data=None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(data).encode()
+    return response
+
+
+class FakeTheHiveApi:
+    def __init__(self, send_delay: float = 0.0):
+        self.send_delay = send_delay
+        self.existing_alerts = {}
+        self.deleted_alerts = set()
+        self.created_alerts = []
+        self.merges = []
+        self.case_updates = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def create_alert(self, alert: Alert) -> requests.Response:
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.send_delay)
+        with self._lock:
+            self.in_flight -= 1
+            if alert.sourceRef in self.existing_alerts:
+                return make_response(400, {'type': 'CreateError'})
+            self.created_alerts.append(alert.sourceRef)
+        return make_response(201, {'id': f'alert-{alert.sourceRef}'})
+
+    def find_alerts(self, query, range: str) -> requests.Response:
+        source_ref = query['_and'][0]['_value']
+        if source_ref in self.existing_alerts:
+            return make_response(200, [{'id': self.existing_alerts[source_ref]}])
+        return make_response(200, [])
+
+    def get_alert(self, alert_id: str) -> requests.Response:
+        return make_response(404 if alert_id in self.deleted_alerts else 200, {'id': alert_id})
+
+    def create_case(self, case: Case) -> requests.Response:
+        return make_response(201, {'id': 'case-1'})
+
+    def merge_alerts_into_case(self, case_id: str, alert_ids) -> requests.Response:
+        if self.deleted_alerts.intersection(alert_ids):
+            return make_response(404, {'type': 'NotFoundError'})
+        self.merges.append((case_id, sorted(alert_ids)))
+        return make_response(200, {'id': case_id})
+
+    def update_case(self, case: Case, fields=None) -> requests.Response:
+        self.case_updates.append((case.id, list(case.tags)))
+        return make_response(200, {'id': case.id})
+
+    def update_custom_field(self, entity_type, entity_id, name, value) -> requests.Response:
+        return make_response(200, {'id': entity_id})
+
+
+class FakeHbaseEventsLoader:
+    def __init__(self):
+        self.raw_available = True
+        self.normalized_available = True
+
+    def get_raw_events(self, event_ids):
+        if not self.raw_available:
+            raise HbaseUnavailableError("Circuit breaker hbase_raw is open")
+        return [f'raw of {event_id}' for event_id in event_ids]
+
+    def get_normalized_events(self, event_ids):
+        if not self.normalized_available:
+            raise HbaseUnavailableError("Circuit breaker hbase_normalized is open")
+        return [make_event(event_id) for event_id in event_ids]
+
+
+def make_event(event_id: str) -> SimpleNamespace:
+    return SimpleNamespace(id=event_id, data=SimpleNamespace(rawIds=[f'raw-{event_id}']))
+
+
+def make_incident(event_ids) -> SimpleNamespace:
+    return SimpleNamespace(correlationEvent=SimpleNamespace(
+        correlation=SimpleNamespace(eventIds=[SimpleNamespace(value=event_id) for event_id in event_ids]),
+        data=SimpleNamespace(rawIds=['raw-incident']),
+    ))
+
+
+@pytest.fixture
+def pusher(tmp_path, monkeypatch):
+    # The pusher flow is tested here, parsing of protobuf messages is covered by SocEventParser
+    monkeypatch.setattr(retry.api, 'time', SimpleNamespace(sleep=lambda delay: None))
+    monkeypatch.setattr(modules.pusher, 'ParseDict', lambda message, *args, **kwargs: message)
+    monkeypatch.setattr(SocEventParser, 'prepare_thehive_case',
+                        lambda incident: Case(title='case', description='case', tags=['usecase']))
+    monkeypatch.setattr(SocEventParser, 'prepare_thehive_alert', lambda event: Alert(
+        title=event.id, type='siem', source='soc', sourceRef=event.id, description='alert', customFields={}
+    ))
+    pusher = TheHivePusher(
+        {'url': 'http://thehive.fake', 'principal': 'fake'},
+        {'namespace': 'fake', 'raw_table_name': 'raw', 'normalized_table_name': 'norm',
+         'deferred_enrichment': {'path': os.path.join(str(tmp_path), 'deferred_enrichments')}},
+        {'initial_limit': 4, 'max_limit': 4},
+        alert_index_settings={'enabled': True, 'path': os.path.join(str(tmp_path), 'alert_index')}
+    )
+    pusher.api = FakeTheHiveApi()
+    pusher.hbase_event_loader = FakeHbaseEventsLoader()
+    pusher.deferred_enrichment.hbase_event_loader = pusher.hbase_event_loader
+    pusher.deferred_enrichment.api = pusher.api
+    yield pusher
+    pusher.close()
+
+
+def test_alerts_are_sent_concurrently_and_merged(pusher):
+    pusher.api.send_delay = 0.05
+    event_ids = [f'e{i}' for i in range(8)]
+    pusher.push(make_incident(event_ids))
+    assert pusher.api.max_in_flight > 1
+    assert pusher.api.merges == [('case-1', sorted(f'alert-{event_id}' for event_id in event_ids))]
+    assert pusher.api.case_updates == [('case-1', ['usecase', 'FINAL'])]
+
+
+def test_indexed_events_are_skipped_but_merged(pusher):
+    pusher.alert_index.add('e1', 'alert-old')
+    pusher.push(make_incident(['e1', 'e2']))
+    assert pusher.api.created_alerts == ['e2']
+    assert pusher.api.merges == [('case-1', ['alert-e2', 'alert-old'])]
+
+
+def test_existing_alert_is_looked_up_after_bad_request(pusher):
+    pusher.api.existing_alerts = {'e1': 'alert-found'}
+    pusher.push(make_incident(['e1', 'e2']))
+    assert pusher.api.merges == [('case-1', ['alert-e2', 'alert-found'])]
+    assert pusher.alert_index.get('e1') == 'alert-found'
+
+
+def test_stale_indexed_alert_is_pushed_again(pusher):
+    pusher.alert_index.add('e1', 'alert-stale')
+    pusher.api.deleted_alerts = {'alert-stale'}
+    pusher.push(make_incident(['e1', 'e2']))
+    assert sorted(pusher.api.created_alerts) == ['e1', 'e2']
+    assert pusher.api.merges == [('case-1', ['alert-e1', 'alert-e2'])]
+    assert pusher.alert_index.get('e1') == 'alert-e1'
+
+
+def test_raw_enrichment_is_deferred_for_case_and_alerts(pusher):
+    pusher.hbase_event_loader.raw_available = False
+    pusher.push(make_incident(['e1', 'e2']))
+    assert pusher.api.merges == [('case-1', ['alert-e1', 'alert-e2'])]
+    assert pusher.deferred_enrichment.backlog_size == 3
+
+    pusher.hbase_event_loader.raw_available = True
+    pusher.deferred_enrichment.process_backlog()
+    assert pusher.deferred_enrichment.backlog_size == 0
+
+
+def test_incident_alerts_are_deferred_while_normalized_events_are_unavailable(pusher):
+    pusher.hbase_event_loader.normalized_available = False
+    pusher.push(make_incident(['e1', 'e2']))
+    assert pusher.api.created_alerts == []
+    assert pusher.api.case_updates == []
+    assert pusher.deferred_enrichment.backlog_size == 1
+
+    pusher.hbase_event_loader.normalized_available = True
+    pusher.deferred_enrichment.process_backlog()
+    assert pusher.deferred_enrichment.backlog_size == 0
+    assert pusher.api.merges == [('case-1', ['alert-e1', 'alert-e2'])]
+    assert pusher.api.case_updates == [('case-1', ['usecase', 'FINAL'])]